@@ -1,41 +1,98 @@
 import os
-import json
+import asyncio
+import hashlib
+import multiprocessing
 import re 
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiofiles
+import orjson
 import fitz  # PyMuPDF
 import pytesseract
-from pdf2image import convert_from_path
+from PIL import Image
 from fastapi.templating import Jinja2Templates
 from fastapi.requests import Request
 from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from langchain_ollama import OllamaLLM
-from langchain_core.prompts import PromptTemplate
-from sqlalchemy import create_engine, Column, String, Integer
+from langchain_ollama import ChatOllama
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from sqlalchemy import create_engine, event, select, text, Column, Index, String, Integer
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 # 🟢 Create storage folder
 UPLOAD_DIR = "PDF_storage"
+UPLOAD_CHUNK_SIZE = 1 << 20  # stream uploads to disk 1 MiB at a time
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+OCR_DPI = 150  # plenty for invoice text; OCR time scales with pixel count
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", os.cpu_count() or 1))
+# tesseract is CPU hungry and every parse worker runs its own OCR threads, so split the cores
+# between workers (cap per worker with MAX_WORKERS)
+OCR_MAX_WORKERS = int(os.environ.get("MAX_WORKERS", max(1, (os.cpu_count() or 1) // PARSE_WORKERS)))
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
 app.mount("/PDF_storage", StaticFiles(directory=UPLOAD_DIR), name="PDF_storage")
 # 🟢 Database setup
 Base = declarative_base()
 engine = create_engine("sqlite:///warehouse.db")
-Session = sessionmaker(bind=engine)
+Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL lets searches read while an upload writes; NORMAL skips the per-commit fsync of the WAL
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
 
 class PurchaseOrder(Base):
     __tablename__ = "purchase_orders"
     id = Column(Integer, primary_key=True)
     po_number = Column(String, unique=True, nullable=False)
     pdf_path = Column(String, nullable=False)
+    # Covering index: /search/ reads pdf_path straight from the index, never touching the table
+    __table_args__ = (Index("ix_po_cover", "po_number", "pdf_path"),)
 
-Base.metadata.create_all(engine)
+class LLMCache(Base):
+    __tablename__ = "llm_cache"
+    prompt_hash = Column(String, primary_key=True)  # sha256 of cleaned_text
+    translated_po = Column(String, nullable=False)
 
-approved_stores = {"829", "899", "436", "499", "407", "115", "712"}
+class PipelineCache(Base):
+    __tablename__ = "pipeline_cache"
+    sha256 = Column(String, primary_key=True)  # of the uploaded PDF bytes
+    translated_po = Column(String, nullable=False)
+    cleaned_text = Column(String, nullable=False)
+
+Base.metadata.create_all(engine)
+# create_all skips indexes on tables that already exist
+for index in PurchaseOrder.__table__.indexes:
+    index.create(engine, checkfirst=True)
+# The planner prefers the UNIQUE autoindex on po_number (then reads the row), so pin the covering index
+SEARCH_PO_SQL = text("SELECT pdf_path FROM purchase_orders INDEXED BY ix_po_cover WHERE po_number = :po LIMIT 1")
+# Rows per multi-row INSERT: 2 params each, under SQLITE_MAX_VARIABLE_NUMBER (999)
+INSERT_BATCH_ROWS = 499
+
+approved_stores = frozenset({"829", "899", "436", "499", "407", "115", "712"})
+_STORES = "|".join(sorted(approved_stores))
+# Like PO_RE, a store code needs a label (store/branch/ship to/dc/#) or a following "jetro";
+# bare 3-digit runs are as often quantities, area codes or weights. Never part of 829.5 or 407-555.
+STORE_RE = re.compile(
+    r"(?:\b(?:store|branch|ship to|dc|distribution center|location)(?: ?(?:no|number)\.?)?[#:\s-]*|#\s*)"
+    r"(" + _STORES + r")\b(?![.-]\d)"
+    r"|\b(" + _STORES + r") jetro\b"
+)
+# Only a 5-digit number right after a PO/order label counts; bare 5-digit runs are usually ZIP codes
+# (a ZIP follows its state code, never the label). Anything else goes to the LLM.
+PO_RE = re.compile(r"\b(?:p\.?o\.?|purchase order|order)(?: ?(?:no|number)\.?)?[#:\s-]*(\d{5})\b")
+# Store codes and POs are all 3+ digit runs; the LLM only needs the text around them
+CANDIDATE_RE = re.compile(r"\d{3,}")
+LLM_MAX_CHARS = 1500
+LLM_WINDOW_CHARS = 80
 
 # 🛠 FIX Prompt: Remove unnecessary variables and escape curly braces properly
 FEW_SHOT_PROMPT = """
@@ -95,88 +152,272 @@ Output:
 {{"translated_po": "712-20091"}}
 
 ---
- 
+"""
 
-Input:
+# Only this part changes per request; everything above is a stable prefix Ollama can keep in its KV cache
+USER_PROMPT = """Input:
 {raw_text}
 Output:
 """
 
-prompt = PromptTemplate(input_variables=["raw_text"], template=FEW_SHOT_PROMPT)
-llm = OllamaLLM(model="llama3")
-translator_chain = prompt | llm
+prompt = ChatPromptTemplate.from_messages([("system", FEW_SHOT_PROMPT), ("user", USER_PROMPT)])
+
+def build_translator_chain():
+    # Small quantized model: the answer is one short JSON object, so cap output tokens and context
+    llm = ChatOllama(
+        model="llama3.2:3b-instruct-q4_K_M",
+        format="json",
+        temperature=0,
+        num_predict=32,
+        num_ctx=2048,
+        keep_alive="24h",
+    )
+    return prompt | llm | StrOutputParser()
+
+translator_chain = build_translator_chain()
 
 # 🛠 FIXED Text Extraction Function
 def extract_text_from_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
-    fitz_text = "\n".join(page.get_text() for page in doc)
-    print("🟡 PyMuPDF extracted:", len(fitz_text.strip()), "characters")
-    if len(fitz_text.strip()) > 100:
-        return fitz_text
-    print("⚠️ Falling back to OCR...")
-    images = convert_from_path(pdf_path)
-    ocr_text = "\n".join(pytesseract.image_to_string(img) for img in images)
+    with fitz.open(pdf_path) as doc:
+        fitz_text = "\n".join(page.get_text("text", sort=False) for page in doc)
+        text_len = len(fitz_text.strip())
+        print("🟡 PyMuPDF extracted:", text_len, "characters")
+        if text_len > 100:
+            return fitz_text
+        print("⚠️ Falling back to OCR...")
+        # Rasterize with the already-open document instead of re-parsing it through Poppler
+        pixmaps = (page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False) for page in doc)
+        images = [Image.frombytes("L", (pm.width, pm.height), pm.samples) for pm in pixmaps]
+    ocr_text = ocr_images(images)
     print("🟡 OCR extracted:", len(ocr_text.strip()), "characters")
     return ocr_text
 
+def ocr_images(images):
+    try:
+        return ocr_images_batch(images)
+    except pytesseract.TesseractError as e:
+        print("⚠️ Batch OCR failed, OCRing pages in parallel:", e)
+    # tesseract releases the GIL, so threads OCR pages concurrently
+    with ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS) as ex:
+        return "\n".join(ex.map(pytesseract.image_to_string, images))
+
+def ocr_images_batch(images):
+    # One tesseract process over a list file instead of one process per page
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i, img in enumerate(images):
+            path = os.path.join(tmp_dir, f"page_{i:04d}.png")
+            img.save(path)
+            paths.append(path)
+        list_file = os.path.join(tmp_dir, "list.txt")
+        with open(list_file, "w") as f:
+            f.write("\n".join(paths) + "\n")
+        # tesseract separates pages with form feeds
+        return pytesseract.image_to_string(list_file).replace("\f", "\n")
+
+def regex_translate_po(text):
+    # Unambiguous text (one labelled store, one labelled 5-digit PO) doesn't need the LLM
+    stores = {labelled or jetro for labelled, jetro in STORE_RE.findall(text)}
+    pos = set(PO_RE.findall(text))
+    if len(stores) == 1 and len(pos) == 1:
+        return f"{stores.pop()}-{pos.pop()}"
+    return None
+
+NEWLINE_RE = re.compile(r'[\n\r]+')
+DISALLOWED_RE = re.compile(r'[^a-z0-9#:\-. ]')
+SPACES_RE = re.compile(r' +')
+
+def llm_snippet(text):
+    # Prompt prefill cost is linear in tokens, so send only the windows around number candidates
+    if len(text) <= LLM_MAX_CHARS:
+        return text
+    spans = []
+    for m in CANDIDATE_RE.finditer(text):
+        start, end = max(0, m.start() - LLM_WINDOW_CHARS), m.end() + LLM_WINDOW_CHARS
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+    if not spans:
+        return text[:LLM_MAX_CHARS]
+    return " ... ".join(text[start:end] for start, end in spans)[:LLM_MAX_CHARS]
+
 def clean_text(text):
-    text = text.lower()
-    text = re.sub(r'[\n\r]+', ' ', text)
-    text = re.sub(r'[^a-z0-9#:\-. ]', '', text)
-    return re.sub(r' +', ' ', text).strip()
+    text = NEWLINE_RE.sub(' ', text.lower())
+    text = DISALLOWED_RE.sub('', text)
+    return SPACES_RE.sub(' ', text).strip()
 
-@app.post("/upload/", response_model=None)
-async def upload_pdf(file: UploadFile = File(...)):
+async def save_upload(file):
     file_location = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_location, "wb") as f:
-        f.write(await file.read())
-
+    hasher = hashlib.sha256()
+    async with aiofiles.open(file_location, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            await f.write(chunk)
+    return file_location, hasher.hexdigest()
+
+# Extract + translate one saved PDF; returns the response body ("error" key on failure)
+def process_pdf(file_location, digest):
     raw_text = extract_text_from_pdf(file_location)
     cleaned_text = clean_text(raw_text)
 
     if not cleaned_text.strip():
         print("❌ No text found.")
-        return JSONResponse(status_code=400, content={"error": "No text extracted."})
+        return {"error": "No text extracted."}
 
     print("📄 Text Preview:", cleaned_text[:300])
 
-    # 🛠 FIXED LLM CALL
-    result = translator_chain.invoke({"raw_text": cleaned_text})
-    print("🧠 Raw LLM Result:", result)
-
-    # 🛠 FIXED JSON PARSE with regex fallback
-    json_match = re.search(r'\{.*?\}', result, re.DOTALL)
-    if json_match:
-        try:
-            po_data = json.loads(json_match.group())
-        except json.JSONDecodeError:
-            print("❌ Invalid JSON structure:", json_match.group())
-            return JSONResponse(status_code=400, content={"error": "Bad JSON", "raw": result})
+    # 🟢 Prompt cache: identical text reuses the stored answer instead of re-running the LLM
+    prompt_hash = hashlib.sha256(cleaned_text.encode("utf-8")).hexdigest()
+    with Session() as session:
+        cached = session.get(LLMCache, prompt_hash)
+    if cached:
+        print("⚡ LLM cache hit:", cached.translated_po)
+        translated_po = cached.translated_po
+    elif fast_po := regex_translate_po(cleaned_text):
+        print("⚡ Regex fast path:", fast_po)
+        translated_po = fast_po
     else:
-        print("❌ No JSON in response.")
-        return JSONResponse(status_code=400, content={"error": "No JSON", "raw": result})
+        # 🛠 FIXED LLM CALL
+        result = translator_chain.invoke({"raw_text": llm_snippet(cleaned_text)})
+        print("🧠 Raw LLM Result:", result)
 
-    translated_po = po_data.get("translated_po", "UNKNOWN")
-    store_code = translated_po.split("-")[0] if "-" in translated_po else "UNKNOWN"
-    if store_code not in approved_stores:
-        print("❌ Invalid store code:", store_code)
-        translated_po = "UNKNOWN"
-
-    session = Session()
-    po_entry = PurchaseOrder(po_number=translated_po, pdf_path=file_location)
-    session.add(po_entry)
-    session.commit()
+        # format="json" makes Ollama emit exactly one JSON object, so no regex fishing needed
+        try:
+            po_data = orjson.loads(result)
+        except orjson.JSONDecodeError:
+            po_data = None
+        if not isinstance(po_data, dict):
+            print("❌ Invalid JSON structure:", result)
+            return {"error": "Bad JSON", "raw": result}
+
+        translated_po = po_data.get("translated_po")
+        # format="json" guarantees an object, not a string value (null, 43610432, ...)
+        if not isinstance(translated_po, str):
+            translated_po = "UNKNOWN"
+        idx = translated_po.find("-")
+        store_code = translated_po[:idx] if idx > 0 else "UNKNOWN"
+        if store_code not in approved_stores:
+            print("❌ Invalid store code:", store_code)
+            translated_po = "UNKNOWN"
+
+        # Workers parsing identical text concurrently race on prompt_hash; first writer wins
+        with Session() as session, session.begin():
+            session.execute(
+                sqlite_insert(LLMCache.__table__).on_conflict_do_nothing(index_elements=["prompt_hash"]),
+                {"prompt_hash": prompt_hash, "translated_po": translated_po},
+            )
+
+    # INSERT OR IGNORE: two in-flight uploads of the same bytes both miss the cache and both land here
+    with Session() as session, session.begin():
+        session.execute(
+            sqlite_insert(PipelineCache.__table__).on_conflict_do_nothing(index_elements=["sha256"]),
+            {"sha256": digest, "translated_po": translated_po, "cleaned_text": cleaned_text},
+        )
+
+    return {"po_number": translated_po, "pdf_path": file_location}
+
+def insert_pos(conn, results):
+    # po_number is UNIQUE. A PO already on file is fine for the same PDF (same path, or a pipeline
+    # cache hit on the same bytes); any other file gets a per-result error instead of repointing the row
+    for i in range(0, len(results), INSERT_BATCH_ROWS):
+        chunk = results[i:i + INSERT_BATCH_ROWS]
+        existing = dict(conn.execute(
+            select(PurchaseOrder.po_number, PurchaseOrder.pdf_path)
+            .where(PurchaseOrder.po_number.in_([result["po_number"] for result in chunk]))
+        ).all())
+        rows = []
+        for result in chunk:
+            pdf_path = existing.get(result["po_number"])
+            if pdf_path is None:
+                rows.append({"po_number": result["po_number"], "pdf_path": result["pdf_path"]})
+            elif pdf_path != result["pdf_path"] and not result.get("cached"):
+                result["error"] = f"PO {result['po_number']} already exists for {pdf_path}"
+        if rows:
+            # One multi-row VALUES statement; DO NOTHING covers a concurrent request inserting first
+            conn.execute(
+                sqlite_insert(PurchaseOrder.__table__).values(rows)
+                .on_conflict_do_nothing(index_elements=["po_number"])
+            )
+
+# 🟢 PDF/OCR/LLM work runs here so it never blocks the event loop; workers are reused across requests.
+# forkserver: workers import this module fresh (own SQLite engine, own Ollama client) instead of
+# forking a parent that already runs threads and holds open connections
+PROCESS_POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+async def run_process_pdf(file_location, digest):
+    # 🟢 Re-upload of identical bytes: reuse the earlier result and skip extract/OCR/LLM entirely
+    with Session() as session:
+        cached = session.get(PipelineCache, digest)
+    if cached:
+        print("⚡ Pipeline cache hit:", cached.translated_po)
+        return {"po_number": cached.translated_po, "pdf_path": file_location, "cached": True}
+    return await asyncio.get_running_loop().run_in_executor(PROCESS_POOL, process_pdf, file_location, digest)
+
+@app.on_event("startup")
+async def _warmup_llm():
+    # Load the model (and the shared system-prompt prefix) before the first real upload
+    try:
+        await asyncio.to_thread(translator_chain.invoke, {"raw_text": "ping"})
+    except Exception as e:
+        print("⚠️ LLM warmup failed:", e)
+
+@app.on_event("shutdown")
+def _shutdown_process_pool():
+    PROCESS_POOL.shutdown(cancel_futures=True)
 
-    return JSONResponse(content={"po_number": translated_po, "pdf_path": file_location})
+@app.post("/upload/", response_model=None)
+async def upload_pdf(file: UploadFile = File(...)):
+    file_location, digest = await save_upload(file)
+    result = await run_process_pdf(file_location, digest)
+    if "error" in result:
+        return ORJSONResponse(status_code=400, content=result)
+
+    with Session() as session, session.begin():
+        insert_pos(session, [result])
+    if "error" in result:
+        return ORJSONResponse(status_code=409, content=result)
+
+    return ORJSONResponse(content=result)
+
+@app.post("/upload_batch/", response_model=None)
+async def upload_pdf_batch(files: list[UploadFile] = File(...)):
+    uploads = [await save_upload(file) for file in files]
+    results = await asyncio.gather(
+        *(run_process_pdf(path, digest) for path, digest in uploads), return_exceptions=True
+    )
+    # A corrupt PDF or an unreachable Ollama fails only that file, not the whole batch
+    results = [
+        {"error": str(result) or type(result).__name__, "pdf_path": path} if isinstance(result, Exception) else result
+        for result, (path, _) in zip(results, uploads)
+    ]
+    pending = {}
+    for result in results:
+        if "error" in result:
+            continue
+        first = pending.setdefault(result["po_number"], result)
+        if first is not result and first["pdf_path"] != result["pdf_path"]:
+            # Same rule as against the table: the first file in the batch keeps the PO
+            result["error"] = f"Duplicate po_number in batch: {result['po_number']}"
+
+    # 🟢 One transaction for the whole batch instead of a commit (and fsync) per PO
+    with engine.begin() as conn:
+        insert_pos(conn, list(pending.values()))
+    for result in results:
+        # A repeat of the same file in the batch shares its first copy's outcome
+        if "error" not in result and "error" in pending[result["po_number"]]:
+            result["error"] = pending[result["po_number"]]["error"]
+
+    return ORJSONResponse(content={"results": results})
 
 # --- Search Route ---
 @app.get("/search/{po}", response_model=None)
 async def search_po(po: str):
-    session = Session()
-    entry = session.query(PurchaseOrder).filter_by(po_number=po).first()
+    with Session() as session:
+        entry = session.execute(SEARCH_PO_SQL, {"po": po}).first()
     if entry:
-        return JSONResponse(content={"pdf_link": f"/PDF_storage/{os.path.basename(entry.pdf_path)}"})
-    return JSONResponse(status_code=404, content={"error": "PO not found"})
+        return ORJSONResponse(content={"pdf_link": f"/PDF_storage/{os.path.basename(entry.pdf_path)}"})
+    return ORJSONResponse(status_code=404, content={"error": "PO not found"})
 
 # --- Frontend HTML UI ---
 @app.get("/")
@@ -7,18 +7,24 @@
 #   t = Cycle theme                    T = Choose theme by name
 
 import asyncio
-import json
 import shutil
 import sqlite3
-import sys
-from dataclasses import dataclass
+import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict, Optional, Tuple, List
 
+import orjson
+
 from textual.app import App, ComposeResult
 from textual.binding import Binding
 from textual.containers import Horizontal, Vertical, VerticalScroll
 from textual.reactive import reactive, var
+from textual.timer import Timer
 from textual.widgets import (
     Header,
     Footer,
@@ -32,14 +38,30 @@ from textual.widgets import (
     Label,
 )
 
-try:
-    from pyfiglet import Figlet
-except Exception:
-    Figlet = None
-
 APP_TITLE = "PDF PARSER TERMINAL UI"
 DB_PATH = "warehouse.db"
-PARSER = [sys.executable, "parse_cli.py"]  # uses your current Python to run parse_cli.py
+THEME_DEBOUNCE_S = 0.05  # coalesce rapid theme switches into one restyle
+
+
+# Pre-rendered so pyfiglet and its font files stay out of the runtime import graph. Regenerate with:
+#   python -c "from pyfiglet import Figlet; print(Figlet(font='doom').renderText('WAREHOUSE CLERK'), end='')"
+_BANNER = r""" _    _  ___  ______ _____ _   _ _____ _   _ _____ _____ 
+| |  | |/ _ \ | ___ \  ___| | | |  _  | | | /  ___|  ___|
+| |  | / /_\ \| |_/ / |__ | |_| | | | | | | \ `--.| |__  
+| |/\| |  _  ||    /|  __||  _  | | | | | | |`--. \  __| 
+\  /\  / | | || |\ \| |___| | | \ \_/ / |_| /\__/ / |___ 
+ \/  \/\_| |_/\_| \_\____/\_| |_/\___/ \___/\____/\____/ 
+                                                         
+                                                         
+ _____  _      ___________ _   __
+/  __ \| |    |  ___| ___ \ | / /
+| /  \/| |    | |__ | |_/ / |/ / 
+| |    | |    |  __||    /|    \ 
+| \__/\| |____| |___| |\ \| |\  \
+ \____/\_____/\____/\_| \_\_| \_/
+                                 
+                                 
+"""
 
 
 # ----------------------------- Themes -----------------------------
@@ -52,6 +74,13 @@ class Theme:
     accent: str
     surface: str
     accent_2: str  # used where cyan was used before
+    # ("round", color) border specs, built once per theme rather than per apply
+    accent_border: Tuple[str, str] = field(init=False, repr=False)
+    surface_border: Tuple[str, str] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.accent_border = ("round", self.accent)
+        self.surface_border = ("round", self.surface)
 
 THEMES: List[Theme] = [
     Theme("dark",   "#0b1020", "#e5e7eb", "#a78bfa", "#11162a", "#22d3ee"),  # original
@@ -65,48 +94,100 @@ THEMES: List[Theme] = [
     Theme("solarlt","#fdf6e3", "#073642", "#268bd2", "#eee8d5", "#2aa198"),
 ]
 
+_HAS_ZENITY = shutil.which("zenity") is not None  # PATH scan once, not on every upload
+
+
 def has_zenity() -> bool:
-    return shutil.which("zenity") is not None
+    return _HAS_ZENITY
 
 
-async def run_subprocess(*args: str) -> Tuple[int, str, str]:
-    """Run a subprocess and return (rc, stdout, stderr) as strings."""
+async def run_subprocess(*args: str) -> Tuple[int, bytes, bytes]:
+    """Run a subprocess and return (rc, stdout, stderr) as raw bytes; callers decode if needed."""
     proc = await asyncio.create_subprocess_exec(
         *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
     )
     out, err = await proc.communicate()
-    return proc.returncode, out.decode("utf-8", "replace"), err.decode("utf-8", "replace")
+    return proc.returncode, out, err
+
+
+def _init_parser_worker() -> None:
+    """Import parser_cli (and build its prompt + LLM client) once per worker."""
+    import parser_cli  # noqa: F401
+
+
+def _parse_in_worker(file_path: str) -> Dict:
+    from parser_cli import parse_pdf
+    return parse_pdf(file_path)
+
+
+def _new_parser_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=1, initializer=_init_parser_worker)
+
+
+# One long-lived parser process: heavy imports and LLM setup happen once, and
+# OCR/LLM work never competes with the UI thread for the GIL.
+PARSER_POOL = _new_parser_pool()
 
 
 async def run_parse_cli(file_path: str) -> Dict:
-    """Run parse_cli.py <file> and return parsed JSON as dict; raise on error."""
-    rc, out, err = await run_subprocess(*PARSER, file_path)
-    if rc != 0:
-        raise RuntimeError(f"Python error (rc={rc}):\n{err or out}")
+    """Parse <file> in the parser worker and return the result dict; raise on error."""
+    global PARSER_POOL
+    loop = asyncio.get_running_loop()
+    pool = PARSER_POOL
     try:
-        return json.loads(out)
-    except Exception as e:
-        raise RuntimeError(f"JSON parse error: {e}\nOutput:\n{out}") from e
+        parsed = await loop.run_in_executor(pool, _parse_in_worker, file_path)
+    except BrokenProcessPool:
+        # The worker died (MuPDF/tesseract segfault, OOM kill); a broken pool never recovers,
+        # so replace it for the next upload and fail only this file
+        if PARSER_POOL is pool:
+            PARSER_POOL = _new_parser_pool()
+        pool.shutdown(wait=False)
+        raise RuntimeError(f"Parser worker crashed while parsing {Path(file_path).name}")
+    if "error" in parsed:
+        raise RuntimeError(f"Parse error:\n{orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode()}")
+    return parsed
+
+
+# One connection for the app's lifetime; sqlite3 caches the prepared SELECT on it.
+# Searches run in executor threads, so access is serialized with a lock.
+_CONN = sqlite3.connect(DB_PATH, check_same_thread=False)
+_CONN.execute("PRAGMA journal_mode=WAL")
+_CONN.execute("PRAGMA synchronous=NORMAL")
+_SEARCH_SQL = "SELECT pdf_path FROM purchase_orders WHERE po_number = ? LIMIT 1"
+try:
+    # Same covering index app.py declares, so PO lookups never touch the table rows
+    _CONN.execute(
+        "CREATE INDEX IF NOT EXISTS ix_po_cover ON purchase_orders(po_number, pdf_path)"
+    )
+    # The planner prefers the UNIQUE autoindex on po_number; pin the covering one
+    _SEARCH_SQL = (
+        "SELECT pdf_path FROM purchase_orders INDEXED BY ix_po_cover"
+        " WHERE po_number = ? LIMIT 1"
+    )
+except sqlite3.OperationalError:
+    pass  # purchase_orders not created yet; app.py adds the index along with the table
+_LOCK = threading.Lock()
+# Searches get their own thread so bursts of other executor work can't queue ahead of them;
+# one worker is enough because _LOCK serializes access to _CONN anyway.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
 
 
 def search_db(po_number: str) -> Optional[str]:
     """Return pdf_path for PO or None if not found. Raises on DB errors."""
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT pdf_path FROM purchase_orders WHERE po_number = ?",
-            (po_number.strip(),),
-        )
-        row = cur.fetchone()
-        return row[0] if row else None
-    finally:
-        conn.close()
-
-
-async def xdg_open(path: str) -> None:
-    # Fire-and-forget; don't await completion
-    asyncio.create_task(run_subprocess("xdg-open", path))
+    with _LOCK:
+        row = _CONN.execute(_SEARCH_SQL, (po_number.strip(),)).fetchone()
+    return row[0] if row else None
+
+
+def xdg_open(path: str) -> None:
+    # Fire-and-forget: detached child, no pipes, nothing for the event loop to reap
+    subprocess.Popen(
+        ["xdg-open", path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
 
 
 # ----------------------------- Widgets -----------------------------
@@ -193,12 +274,16 @@ class UploadPane(Vertical):
     def set_state(self, payload: ParseState) -> None:
         self.state = payload
         table = self.query_one(DataTable)
-        table.clear()
-        for k in sorted(payload.kv.keys(), key=lambda s: s.lower()):
-            v = str(payload.kv[k])
-            table.add_row(k, v)
         raw = self.query_one("#raw_log", Static)
-        raw.update(payload.raw)
+        # Lowercase each key once and sort plain tuples; no key function per comparison
+        items = [(k.lower(), k, str(v)) for k, v in payload.kv.items()]
+        items.sort()
+        rows = [(k, v) for _, k, v in items]
+        # One batched insert and a single repaint instead of one invalidation per row
+        with self.app.batch_update():
+            table.clear()
+            table.add_rows(rows)
+            raw.update(payload.raw)
 
     def clear(self) -> None:
         self.state = None
@@ -365,15 +450,12 @@ class WarehouseClerkApp(App):
     status = reactive("Ready.")
     found_pdf: Optional[str] = reactive(None)
     theme_index: int = reactive(0)  # start at 0 ("dark")
+    _pending_theme: Optional[Theme] = None
+    _apply_timer: Optional[Timer] = None
+    _w: Optional[SimpleNamespace] = None  # cached widget handles for apply_theme
 
     def _banner_text(self) -> str:
-        text = "WAREHOUSE CLERK"
-        if Figlet:
-            try:
-                return Figlet(font="doom").renderText(text)
-            except Exception:
-                pass
-        return text
+        return _BANNER
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=False)
@@ -410,7 +492,7 @@ class WarehouseClerkApp(App):
                 "--file-filter=PDF files | *.pdf",
             )
             if rc == 0:
-                file_path = out.strip()
+                file_path = out.decode("utf-8", "replace").strip()
         if not file_path:
             ipt = await self.request_input(
                 "Enter PDF path (zenity not available or canceled):"
@@ -432,13 +514,16 @@ class WarehouseClerkApp(App):
         """Open the last-found PDF (if any)."""
         if self.found_pdf:
             self.status = "Opening PDF…"
-            await xdg_open(self.found_pdf)
+            try:
+                xdg_open(self.found_pdf)
+            except OSError as e:
+                self.status = f"Could not open PDF: {e}"
         else:
             self.status = "No PDF selected/found."
 
     def action_cycle_theme(self) -> None:
         self.theme_index = (self.theme_index + 1) % len(THEMES)
-        self.apply_theme(THEMES[self.theme_index])
+        self._schedule_apply(THEMES[self.theme_index])
 
     async def action_choose_theme(self) -> None:
         name = await self.request_input(
@@ -450,7 +535,7 @@ class WarehouseClerkApp(App):
         for i, t in enumerate(THEMES):
             if t.name == name:
                 self.theme_index = i
-                self.apply_theme(t)
+                self._schedule_apply(t)
                 return
         self.status = f"Unknown theme '{name}'."
 
@@ -462,10 +547,12 @@ class WarehouseClerkApp(App):
         inp = Input(placeholder=prompt)
         container = Horizontal(inp, Button("OK", id="ok_btn"))
         await sb.mount(container)
+        self._w = None  # widget tree changed; re-cache handles on next theme apply
 
-        fut: asyncio.Future[str] = asyncio.get_event_loop().create_future()
+        fut: asyncio.Future[str] = asyncio.get_running_loop().create_future()
 
         def cleanup() -> None:
+            self._w = None
             try:
                 container.remove()
             except Exception:
@@ -489,77 +576,89 @@ class WarehouseClerkApp(App):
         finally:
             cleanup()
 
+    def _schedule_apply(self, t: Theme) -> None:
+        """Queue a theme; repeated calls within the debounce window restyle only once."""
+        self._pending_theme = t
+        if self._apply_timer is None:
+            self._apply_timer = self.set_timer(THEME_DEBOUNCE_S, self._flush_theme)
+
+    def _flush_theme(self) -> None:
+        self._apply_timer = None
+        t, self._pending_theme = self._pending_theme, None
+        if t is not None:
+            self.apply_theme(t)
+
+    def _cache_widgets(self) -> SimpleNamespace:
+        """Look up every widget apply_theme styles once, instead of per theme switch."""
+        up = self.query_one("#upload_pane", UploadPane)
+        sp = self.query_one("#search_pane", SearchPane)
+        self._w = SimpleNamespace(
+            title=self.query_one("#titlebar", Static),
+            banner=self.query_one("#banner", Static),
+            helpbar_label=self.query_one("#helpbar", Label),
+            statusbar=self.query_one("#statusbar", StatusBar),
+            tabs=self.query_one(TabbedContent),
+            labels=list(self.query(".label")),
+            buttons=list(self.query(Button)),
+            kv_table=up.query_one("#kv_table", DataTable),
+            raw_wrap=up.query_one("#raw_wrap", VerticalScroll),
+            raw_log=up.query_one("#raw_log", Static),
+            result_box=sp.query_one("#result_box", Static),
+            po_input=sp.query_one("#po_input", Input),
+        )
+        return self._w
+
     def apply_theme(self, t: Theme) -> None:
         """Apply colors to all key widgets (no CSS variables; runtime styling)."""
+        w = self._w or self._cache_widgets()
+
         # Screen
         self.screen.styles.background = t.background
         self.screen.styles.color = t.foreground
 
         # Titlebar + banner + help/status text
-        title = self.query_one("#titlebar", Static)
-        title.styles.background = t.background
-        title.styles.color = t.accent
+        w.title.styles.background = t.background
+        w.title.styles.color = t.accent
 
-        banner = self.query_one("#banner", Static)
-        banner.styles.background = t.background
-        banner.styles.color = t.accent
+        w.banner.styles.background = t.background
+        w.banner.styles.color = t.accent
 
-        helpbar_label = self.query_one("#helpbar", Label)
-        helpbar_label.styles.color = t.foreground
+        w.helpbar_label.styles.color = t.foreground
 
-        statusbar = self.query_one("#statusbar", StatusBar)
+        statusbar = w.statusbar
         statusbar.styles.color = t.foreground
         statusbar.styles.background = t.background
-        statusbar.styles.border_top = ("round", t.surface)
-        statusbar.styles.border_right = ("round", t.surface)
-        statusbar.styles.border_bottom = ("round", t.surface)
-        statusbar.styles.border_left = ("round", t.surface)
+        statusbar.styles.border = t.surface_border
 
         # Tabs container border + active tab color
-        tabs = self.query_one(TabbedContent)
-        tabs.styles.border_top = ("round", t.accent)
-        tabs.styles.border_right = ("round", t.accent)
-        tabs.styles.border_bottom = ("round", t.accent)
-        tabs.styles.border_left = ("round", t.accent)
+        tabs = w.tabs
+        tabs.styles.border = t.accent_border
         tabs.styles.background = t.background
         tabs.styles.color = t.foreground
 
         # Labels accent
-        for lab in self.query(".label"):
+        for lab in w.labels:
             lab.styles.color = t.accent
 
         # Buttons border color
-        for btn in self.query(Button):
-            btn.styles.border_top = ("round", t.surface)
-            btn.styles.border_right = ("round", t.surface)
-            btn.styles.border_bottom = ("round", t.surface)
-            btn.styles.border_left = ("round", t.surface)
+        for btn in w.buttons:
             if "-primary" in (btn.classes or set()):
-                btn.styles.border_top = ("round", t.accent)
-                btn.styles.border_right = ("round", t.accent)
-                btn.styles.border_bottom = ("round", t.accent)
-                btn.styles.border_left = ("round", t.accent)
+                btn.styles.border = t.accent_border
+            else:
+                btn.styles.border = t.surface_border
             btn.styles.color = t.foreground
             btn.styles.background = t.background
 
         # Upload pane borders + table color
-        up = self.query_one("#upload_pane", UploadPane)
-        kv_table = up.query_one("#kv_table", DataTable)
-        for side in ("border_top", "border_right", "border_bottom", "border_left"):
-            setattr(kv_table.styles, side, ("round", t.accent))
-        raw_wrap = up.query_one("#raw_wrap", VerticalScroll)
-        for side in ("border_top", "border_right", "border_bottom", "border_left"):
-            setattr(raw_wrap.styles, side, ("round", t.surface))
-        up.query_one("#raw_log", Static).styles.color = t.foreground
-        up.query_one("#raw_log", Static).styles.background = t.background
+        w.kv_table.styles.border = t.accent_border
+        w.raw_wrap.styles.border = t.surface_border
+        w.raw_log.styles.color = t.foreground
+        w.raw_log.styles.background = t.background
 
         # Search pane border
-        sp = self.query_one("#search_pane", SearchPane)
-        result_box = sp.query_one("#result_box", Static)
-        for side in ("border_top", "border_right", "border_bottom", "border_left"):
-            setattr(result_box.styles, side, ("round", t.surface))
+        w.result_box.styles.border = t.surface_border
         # Inputs inherit foreground/background
-        for wid in (sp.query_one("#po_input", Input),):
+        for wid in (w.po_input,):
             wid.styles.color = t.foreground
             wid.styles.background = t.background
 
@@ -577,10 +676,9 @@ class WarehouseClerkApp(App):
         self.status = "Parsing file…"
         try:
             parsed = await run_parse_cli(msg.file_path)
-            # Build kv + pretty raw JSON
-            kv = {k: parsed[k] for k in parsed.keys()}
-            pretty = json.dumps(parsed, indent=2)
-            pane.set_state(ParseState(kv=kv, raw=pretty))
+            # Parsed dict is already the kv table; just add pretty raw JSON
+            pretty = orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode()
+            pane.set_state(ParseState(kv=parsed, raw=pretty))
             self.status = "Parsing complete."
             # Switch to Upload tab to show results (if not already there)
             self.query_one(TabbedContent).active = "upload_tab"
@@ -599,11 +697,7 @@ class WarehouseClerkApp(App):
             return
 
         self.status = "Searching database…"
-
-        def _work() -> Optional[str]:
-            return search_db(po)
-
-        pdf = await asyncio.get_event_loop().run_in_executor(None, _work)
+        pdf = await asyncio.get_running_loop().run_in_executor(_DB_EXECUTOR, search_db, po)
         if pdf is None:
             pane.set_result("PO not found.", None)
             self.found_pdf = None
@@ -619,5 +713,11 @@ class WarehouseClerkApp(App):
 
 
 if __name__ == "__main__":
+    # Start (and warm) the parser worker before Textual spins up its threads
+    PARSER_POOL.submit(_init_parser_worker)
     app = WarehouseClerkApp()
-    app.run()
+    try:
+        app.run()
+    finally:
+        PARSER_POOL.shutdown(cancel_futures=True)
+        _DB_EXECUTOR.shutdown(cancel_futures=True)
@@ -1,14 +1,17 @@
+import os
 import sys
-import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF
+import orjson
 import pytesseract
-from pdf2image import convert_from_path
-from langchain_ollama import OllamaLLM
-from langchain_core.prompts import PromptTemplate
+from PIL import Image
+from langchain_ollama import ChatOllama
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
 
 # Approved stores
-approved_stores = {"829", "899", "436", "499", "407", "115", "712"}
+approved_stores = frozenset({"829", "899", "436", "499", "407", "115", "712"})
 
 # Prompt template
 FEW_SHOT_PROMPT = """
@@ -68,61 +71,118 @@ Output:
 {{"translated_po": "712-20091"}}
 
 ---
- 
+"""
 
-Input:
+# Only this part changes per request; everything above is a stable prefix Ollama can keep in its KV cache
+USER_PROMPT = """Input:
 {raw_text}
 Output:
 """
 
-prompt = PromptTemplate(input_variables=["raw_text"], template=FEW_SHOT_PROMPT)
-llm = OllamaLLM(model="llama3")
-translator_chain = prompt | llm
+prompt = ChatPromptTemplate.from_messages([("system", FEW_SHOT_PROMPT), ("user", USER_PROMPT)])
+# Small quantized model: the answer is one short JSON object, so cap output tokens and context
+llm = ChatOllama(
+    model="llama3.2:3b-instruct-q4_K_M", temperature=0, num_predict=40, num_ctx=2048, keep_alive="24h"
+)
+translator_chain = prompt | llm | StrOutputParser()
+
+# A page with less stripped text than this is treated as a scan and OCRed
+THIN_PAGE_CHARS = 50
 
 def extract_text_from_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
-    fitz_text = "\n".join(page.get_text() for page in doc)
-    if len(fitz_text.strip()) > 100:
-        return fitz_text
-    images = convert_from_path(pdf_path)
-    ocr_text = "\n".join(pytesseract.image_to_string(img) for img in images)
-    return ocr_text
+    with fitz.open(pdf_path) as doc:
+        parts = []
+        total = 0
+        for page in doc:
+            parts.append(page.get_text("text", sort=False))
+            total += len(parts[-1].strip())
+        if total > 100:
+            return "\n".join(parts)
+        # OCR thin pages (scans often carry a "Page 1" footer or scanner stamp as text) and keep
+        # fitz text on the rest; if no single page is thin, the whole document is, so OCR it all
+        thin = [i for i, text in enumerate(parts) if len(text.strip()) < THIN_PAGE_CHARS]
+        thin = thin or list(range(len(parts)))
+        # 150 DPI grayscale is plenty for invoice text and OCR time scales with pixel count
+        pixmaps = (doc[i].get_pixmap(dpi=150, colorspace=fitz.csGRAY, alpha=False) for i in thin)
+        images = [Image.frombytes("L", (pm.width, pm.height), pm.samples) for pm in pixmaps]
+    if images:
+        # tesseract releases the GIL, so pages OCR concurrently across cores
+        with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as ex:
+            for i, text in zip(thin, ex.map(pytesseract.image_to_string, images)):
+                parts[i] = text
+    return "\n".join(parts)
+
+# ASCII translate table: keep the allowed set, newlines become word breaks, drop the rest
+_KEEP = set(b"abcdefghijklmnopqrstuvwxyz0123456789#:-. ")
+_TRANS = {b: (None if b not in b"\n\r" else " ") for b in range(128) if b not in _KEEP}
+_WS_RE = re.compile(r' +')
 
 def clean_text(text):
-    text = text.lower()
-    text = re.sub(r'[\n\r]+', ' ', text)
-    text = re.sub(r'[^a-z0-9#:\-. ]', '', text)
-    return re.sub(r' +', ' ', text).strip()
-
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(json.dumps({"error": "No file path provided"}))
-        sys.exit(1)
-
-    file_path = sys.argv[1]
+    # encode("ascii", "ignore") drops every non-ASCII char in C before the table pass
+    text = text.lower().encode("ascii", "ignore").decode("ascii").translate(_TRANS)
+    return _WS_RE.sub(' ', text).strip()
+
+def _extract_json(s):
+    """Return the first balanced {...} object in s (braces inside strings ignored), or None."""
+    start = s.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
+
+def parse_pdf(file_path):
+    """Parse one PDF and return {"po_number": ...}, or {"error": ...} on failure."""
     raw_text = extract_text_from_pdf(file_path)
     cleaned_text = clean_text(raw_text)
 
     if not cleaned_text.strip():
-        print(json.dumps({"error": "No text extracted"}))
-        sys.exit(1)
+        return {"error": "No text extracted"}
 
     result = translator_chain.invoke({"raw_text": cleaned_text})
-    json_match = re.search(r'\{.*?\}', result, re.DOTALL)
-    if json_match:
-        try:
-            po_data = json.loads(json_match.group())
-        except json.JSONDecodeError:
-            print(json.dumps({"error": "Bad JSON", "raw": result}))
-            sys.exit(1)
-    else:
-        print(json.dumps({"error": "No JSON", "raw": result}))
-        sys.exit(1)
+    raw_json = _extract_json(result)
+    if raw_json is None:
+        return {"error": "No JSON", "raw": result}
+    try:
+        po_data = orjson.loads(raw_json)
+    except orjson.JSONDecodeError:
+        return {"error": "Bad JSON", "raw": result}
 
     translated_po = po_data.get("translated_po", "UNKNOWN")
-    store_code = translated_po.split("-")[0] if "-" in translated_po else "UNKNOWN"
-    if store_code not in approved_stores:
+    idx = translated_po.find("-")
+    if idx <= 0 or translated_po[:idx] not in approved_stores:
         translated_po = "UNKNOWN"
 
-    print(json.dumps({"po_number": translated_po}))
+    return {"po_number": translated_po}
+
+def _write_json(obj):
+    # orjson emits UTF-8 bytes; write them straight to stdout without a str round-trip
+    sys.stdout.buffer.write(orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE))
+    sys.stdout.buffer.flush()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        _write_json({"error": "No file path provided"})
+        sys.exit(1)
 
+    parsed = parse_pdf(sys.argv[1])
+    _write_json(parsed)
+    if "error" in parsed:
+        sys.exit(1)